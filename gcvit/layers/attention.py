@@ -1,3 +1,4 @@
+import numpy as np
 import tensorflow as tf
 
 
@@ -12,6 +13,9 @@ class WindowAttention(tf.keras.layers.Layer):
         qk_scale=None,
         attn_dropout=0.0,
         proj_dropout=0.0,
+        use_xla=False,
+        chunk_size=None,
+        fused_qkv=True,
         **kwargs
     ):
         super().__init__(**kwargs)
@@ -23,15 +27,43 @@ class WindowAttention(tf.keras.layers.Layer):
         self.qk_scale = qk_scale
         self.attn_dropout = attn_dropout
         self.proj_dropout = proj_dropout
+        self.use_xla = use_xla
+        self.chunk_size = chunk_size
+        self.fused_qkv = fused_qkv
+        if self.use_xla:
+            # keep fusion ownership with XLA: grappler's remapper also
+            # targets the matmul+bias-add+softmax pattern and the double
+            # rewrite can emit fused ops XLA cannot lower
+            tf.config.optimizer.set_experimental_options(
+                {"remapping": False}
+            )
 
     def build(self, input_shape):
         dim = input_shape[0][-1]
         head_dim = dim // self.num_heads
+        # window_size and dim are fixed at build time; keeping N and C as
+        # Python ints gives XLA static shapes to tile and unroll against
+        self.dim = dim
+        self.num_tokens = self.window_size[0] * self.window_size[1]
         self.scale = self.qk_scale or head_dim**-0.5
         self.qkv_size = 3 - int(self.global_query)
-        self.qkv = tf.keras.layers.Dense(
-            dim * self.qkv_size, use_bias=self.qkv_bias, name="qkv"
-        )
+        if self.fused_qkv:
+            self.qkv = tf.keras.layers.Dense(
+                dim * self.qkv_size, use_bias=self.qkv_bias, name="qkv"
+            )
+        else:
+            # independent projections; only pretrained checkpoints for
+            # the fused layout exist, so this path is opt-in
+            if not self.global_query:
+                self.q_proj = tf.keras.layers.Dense(
+                    dim, use_bias=self.qkv_bias, name="q_proj"
+                )
+            self.k_proj = tf.keras.layers.Dense(
+                dim, use_bias=self.qkv_bias, name="k_proj"
+            )
+            self.v_proj = tf.keras.layers.Dense(
+                dim, use_bias=self.qkv_bias, name="v_proj"
+            )
         self.relative_position_bias_table = self.add_weight(
             "relative_position_bias_table",
             shape=[
@@ -49,86 +81,158 @@ class WindowAttention(tf.keras.layers.Layer):
         self.proj_drop = tf.keras.layers.Dropout(
             self.proj_dropout, name="proj_drop"
         )
-        self.softmax = tf.keras.layers.Activation("softmax", name="softmax")
-        self.relative_position_index = self.get_relative_position_index()
+        # plain constant (not a Variable) so XLA can fold the bias gather
+        self.relative_position_index = tf.constant(
+            self.get_relative_position_index(), dtype=tf.int32
+        )
+        # XLA fuses the scale/matmul/bias-add/softmax chain into fewer
+        # kernels; keep a jitted copy of the forward pass when requested.
+        # With XLA_FLAGS=--xla_gpu_enable_cudnn_fmha=true and a fp16/bf16
+        # policy, the whole chain maps to a single cuDNN flash-attention
+        # kernel.
+        self._forward_fn = (
+            tf.function(self._forward, jit_compile=True)
+            if self.use_xla
+            else self._forward
+        )
         super().build(input_shape)
 
     def get_relative_position_index(self):
-        coords_h = tf.range(self.window_size[0])
-        coords_w = tf.range(self.window_size[1])
-        coords = tf.stack(
-            tf.meshgrid(coords_h, coords_w, indexing="ij"), axis=0
+        # fully static integer matrix, so build it in numpy: no TF graph
+        # nodes at build time and a clean constant for the bias gather
+        coords_h = np.arange(self.window_size[0])
+        coords_w = np.arange(self.window_size[1])
+        coords = np.stack(
+            np.meshgrid(coords_h, coords_w, indexing="ij"), axis=0
         )
-        coords_flatten = tf.reshape(coords, [2, -1])
+        coords_flatten = coords.reshape(2, -1)
         relative_coords = (
             coords_flatten[:, :, None] - coords_flatten[:, None, :]
-        )
-        relative_coords = tf.transpose(relative_coords, perm=[1, 2, 0])
+        ).transpose(1, 2, 0)
         relative_coords_xx = relative_coords[:, :, 0] + self.window_size[0] - 1
         relative_coords_yy = relative_coords[:, :, 1] + self.window_size[1] - 1
         relative_coords_xx = relative_coords_xx * (2 * self.window_size[1] - 1)
         relative_position_index = relative_coords_xx + relative_coords_yy
         return relative_position_index
 
-    def call(self, inputs, **kwargs):
+    def get_relative_position_bias(self):
+        # transposing the small [M, num_heads] table first lets a single
+        # gather produce the bias directly, instead of gather+reshape+
+        # transpose over the full bias tensor every call; the leading 1
+        # is attached here so the bias is already the broadcast operand
+        # of the attention add ([1, num_heads, N, N])
+        bias_table = tf.transpose(self.relative_position_bias_table)
+        bias = tf.gather(bias_table, self.relative_position_index, axis=1)
+        return bias[
+            tf.newaxis,
+        ]
+
+    def _attention(self, q, k, v, training=None):
+        # scale the scores (not q) so the op order is exactly
+        # bmm1 -> scale -> bias-add -> softmax -> dropout -> bmm2, the
+        # pattern XLA's CudnnFusedMHARewriter turns into one fused kernel
+        attn = tf.einsum("...qhd,...khd->...hqk", q, k) * self.scale
+        attn = attn + self.get_relative_position_bias()
+        # float32 softmax even under a mixed fp16/bf16 policy; the plain
+        # op (vs an Activation layer) keeps the canonical HLO pattern the
+        # cuDNN FMHA rewriter matches on
+        attn = tf.nn.softmax(tf.cast(attn, tf.float32), axis=-1)
+        attn = self.attn_drop(attn, training=training)
+        attn = tf.cast(attn, v.dtype)
+        return tf.einsum(
+            "...hqk,...khd->...qhd", attn, v
+        )  # B_, num_tokens, num_heads, channels_per_head
+
+    def _chunked_attention(self, q, k, v, training=None):
+        # process chunk_size query tokens at a time so only a
+        # [B_, H, chunk, N] slice of the scores is ever materialized;
+        # num_tokens is a Python int, so under jit_compile the loop
+        # unrolls with a compile-time chunk count
+        relative_position_bias = self.get_relative_position_bias()
+        x = []
+        for start in range(0, self.num_tokens, self.chunk_size):
+            stop = min(start + self.chunk_size, self.num_tokens)
+            attn = (
+                tf.einsum(
+                    "...qhd,...khd->...hqk", q[..., start:stop, :, :], k
+                )
+                * self.scale
+            )
+            attn = attn + relative_position_bias[:, :, start:stop]
+            attn = tf.nn.softmax(tf.cast(attn, tf.float32), axis=-1)
+            attn = self.attn_drop(attn, training=training)
+            attn = tf.cast(attn, v.dtype)
+            x.append(tf.einsum("...hqk,...khd->...qhd", attn, v))
+        return tf.concat(x, axis=-3)
+
+    def call(self, inputs, training=None, **kwargs):
         if self.global_query:
             inputs, q_global = inputs
-            B = tf.shape(q_global)[0]  # B, N, C
         else:
             inputs = inputs[0]
-        B_, N, C = tf.unstack(
-            tf.shape(inputs), num=3
-        )  # B*num_window, num_tokens, channels
-        qkv = self.qkv(inputs)
-        qkv = tf.reshape(
-            qkv, [B_, N, self.qkv_size, self.num_heads, C // self.num_heads]
-        )
-        qkv = tf.transpose(qkv, [2, 0, 3, 1, 4])
+            q_global = None
+        return self._forward_fn(inputs, q_global, training)
+
+    def _forward(self, inputs, q_global=None, training=None):
         if self.global_query:
-            k, v = tf.unstack(
-                qkv, num=2, axis=0
-            )  # for unknown shame num=None will throw error
-            q_global = tf.repeat(
-                q_global, repeats=B_ // B, axis=0
-            )  # num_windows = B_//B => q_global same for all windows in a img
+            B = tf.shape(q_global)[0]  # B, N, C
+        B_ = tf.shape(inputs)[0]  # B*num_window (only dynamic dim)
+        N = self.num_tokens  # num_tokens, static
+        C = self.dim  # channels, static
+        if self.fused_qkv:
+            qkv = self.qkv(inputs)
+            # single reshape, no [2, 0, 3, 1, 4] transpose: q/k/v come
+            # out as [B_, N, num_heads, head_dim] views of the qkv tensor
+            qkv = tf.reshape(
+                qkv,
+                [B_, N, self.qkv_size, self.num_heads, C // self.num_heads],
+            )
+            # slice instead of tf.unstack: strided reads the following
+            # einsums consume directly, no materialized copies in eager
+            if self.global_query:
+                k, v = qkv[:, :, 0], qkv[:, :, 1]
+            else:
+                q, k, v = qkv[:, :, 0], qkv[:, :, 1], qkv[:, :, 2]
+        else:
+            # independent projections write straight into the head-last
+            # layout and can overlap on separate streams outside XLA
+            k = tf.reshape(
+                self.k_proj(inputs),
+                [B_, N, self.num_heads, C // self.num_heads],
+            )
+            v = tf.reshape(
+                self.v_proj(inputs),
+                [B_, N, self.num_heads, C // self.num_heads],
+            )
+            if not self.global_query:
+                q = tf.reshape(
+                    self.q_proj(inputs),
+                    [B_, N, self.num_heads, C // self.num_heads],
+                )
+        if self.global_query:
+            # q_global is the same for all windows in a img, so instead
+            # of tf.repeat-ing it num_windows (B_//B) times, expose the
+            # window axis on k/v and let the einsums broadcast q over it
+            k = tf.reshape(
+                k, [B, B_ // B, N, self.num_heads, C // self.num_heads]
+            )
+            v = tf.reshape(
+                v, [B, B_ // B, N, self.num_heads, C // self.num_heads]
+            )
             q = tf.reshape(
-                q_global, shape=[B_, N, self.num_heads, C // self.num_heads]
+                q_global,
+                shape=[B, 1, N, self.num_heads, C // self.num_heads],
             )
-            q = tf.transpose(q, perm=[0, 2, 1, 3])
+        if self.chunk_size is None:
+            x = self._attention(q, k, v, training=training)
         else:
-            q, k, v = tf.unstack(qkv, num=3, axis=0)
-        q = q * self.scale
-        attn = q @ tf.transpose(k, perm=[0, 1, 3, 2])
-        relative_position_bias = tf.gather(
-            self.relative_position_bias_table,
-            tf.reshape(self.relative_position_index, shape=[-1]),
-        )
-        relative_position_bias = tf.reshape(
-            relative_position_bias,
-            shape=[
-                self.window_size[0] * self.window_size[1],
-                self.window_size[0] * self.window_size[1],
-                -1,
-            ],
-        )
-        relative_position_bias = tf.transpose(
-            relative_position_bias, perm=[2, 0, 1]
-        )
-        attn = (
-            attn
-            + relative_position_bias[
-                tf.newaxis,
-            ]
-        )
-        attn = self.softmax(attn)
-        attn = self.attn_drop(attn)
-
-        x = tf.transpose(
-            (attn @ v), perm=[0, 2, 1, 3]
-        )  # B_, num_tokens, num_heads, channels_per_head
-        x = tf.reshape(x, shape=[B_, N, C])
+            x = self._chunked_attention(q, k, v, training=training)
+        # collapse tokens into the batch dim so proj runs as one plain
+        # GEMM instead of a strided batched matmul over B_
+        x = tf.reshape(x, shape=[-1, C])
         x = self.proj(x)
-        x = self.proj_drop(x)
+        x = tf.reshape(x, shape=[B_, N, C])
+        x = self.proj_drop(x, training=training)
         return x
 
     def get_config(self):
@@ -142,6 +246,9 @@ class WindowAttention(tf.keras.layers.Layer):
                 "qk_scale": self.qk_scale,
                 "attn_dropout": self.attn_dropout,
                 "proj_dropout": self.proj_dropout,
+                "use_xla": self.use_xla,
+                "chunk_size": self.chunk_size,
+                "fused_qkv": self.fused_qkv,
             }
         )
         return config
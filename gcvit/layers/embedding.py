@@ -10,6 +10,9 @@ class Stem(tf.keras.layers.Layer):
         self.dim = dim
 
     def build(self, input_shape):
+        # explicit symmetric pad like PyTorch Conv2d(padding=1); Conv2D
+        # with padding='same' pads (0, 1) for stride 2, which shifts the
+        # sampling grid and breaks parity with the pretrained weights
         self.pad = tf.keras.layers.ZeroPadding2D(1, name="pad")
         self.proj = tf.keras.layers.Conv2D(
             self.dim, kernel_size=3, strides=2, name="proj"
@@ -3,3 +3,4 @@ from .conv_utils import normalize_tuple
 from .gradcam import get_gradcam_model
 from .gradcam import get_gradcam_prediction
 from .gradcam import process_image
+from .quantize import quantize_model
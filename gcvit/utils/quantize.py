@@ -0,0 +1,45 @@
+import tensorflow as tf
+
+
+def quantize_model(
+    model,
+    input_shape=(224, 224, 3),
+    representative_data=None,
+    save_path=None,
+):
+    """Post-training quantization of a GCViT model to int8 TFLite
+
+    The qkv/proj Dense layers dominate CPU inference; dynamic range
+    quantization stores their weights in int8 so the matmuls run on
+    XNNPACK's int8 (AVX-VNNI) kernels, while softmax and the attention
+    matmuls stay in float for numerical stability. Passing
+    representative_data additionally calibrates int8 activations.
+
+    Args:
+        model (GCViT): built model, e.g. GCViTXXTiny(pretrain=True)
+        input_shape (tuple, optional): input shape without batch dim.
+            Defaults to (224, 224, 3).
+        representative_data (iterable, optional): batches of example
+            inputs for activation calibration. Defaults to None.
+        save_path (str, optional): where to write the .tflite file.
+            Defaults to None.
+
+    Returns:
+        bytes: serialized TFLite flatbuffer
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(
+        model.build_graph(input_shape)
+    )
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if representative_data is not None:
+
+        def representative_dataset():
+            for sample in representative_data:
+                yield [tf.cast(sample, tf.float32)]
+
+        converter.representative_dataset = representative_dataset
+    tflite_model = converter.convert()
+    if save_path is not None:
+        with open(save_path, "wb") as f:
+            f.write(tflite_model)
+    return tflite_model